@@ -1,19 +1,22 @@
 #!/usr/bin/python
 import argparse
-import glob
+import collections
+import concurrent.futures
+import errno
+import functools
+import itertools
 import logging
 import logging.config
 import shlex
 import subprocess
-from subprocess import call, check_output
+from subprocess import check_output
 
-import codecs
 import os
 import re
 import shutil
 import tempfile
 from os import listdir
-from os.path import isfile, join
+from os.path import join
 
 TMP_DIR_PREFIX = 'cueconvert_'
 logger = logging.getLogger(__name__)
@@ -21,7 +24,40 @@ log_level = 'INFO' # default log level.
 
 SUPPORTED_SOURCE_FORMATS = ['m4a', 'wav', 'ape', 'wv']
 
+# Cue sheet line matchers. Compiled once since they run against every cue line.
+_HEADER_RE = re.compile(r'^(TITLE|PERFORMER|REM DATE) (.*)$')
+_DISC_TITLE_RE = re.compile(r'[ \t]*TITLE (.*)$')
+# INDEX line with its m:ss:ff time and optional trailing whitespace
+_INDEX_FIX_RE = re.compile(r'^(\s*INDEX\s+\d+\s+\d+:\d+:\d+)(\s*)$')
+
+@functools.lru_cache(maxsize=4096)
+def _unquote_first(value):
+    """Returns first token of cue value with optionally present quotes removed."""
+    # Most cue values are a single plain quoted string, no need for shlex then
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"' \
+            and value.count('"') == 2 and '\\' not in value:
+        return value[1:-1]
+    return shlex.split(value)[0]
+
+def _parse_file_name(line):
+    """Returns music file name from cue line like FILE "name (LP1).flac" WAVE"""
+    # only when the name itself is double quoted, line is known to start with 'FILE '
+    if line[5:6] == '"' and '\\' not in line:
+        end = line.find('"', 6)
+        # closing quote has to end the token, otherwise shlex glues the rest to the name
+        if end != -1 and line[end + 1:end + 2] in ('', ' ', '\t'):
+            return line[6:end]
+    # unquoted, single quoted or escaped name
+    return shlex.split(line)[1]
+
 class CueAlbum:
+    # cue header keyword -> album attribute it populates
+    HEADER_TAGS = {
+        'TITLE': 'album_tag',
+        'PERFORMER': 'artist_tag',
+        'REM DATE': 'year_tag',
+    }
+
     def __init__(self):
         self.album_tag = None
         self.artist_tag = None
@@ -35,25 +71,13 @@ class CueAlbum:
 
     def append_line_to_header(self, line):
         self.header.append(line)
-        self._populate_album_tag(line)
-        self._populate_artist_tag(line)
-        self._populate_year_tag(line)
-
-    def _populate_album_tag(self, line):
-        match = re.match('^TITLE (.*)$', line)
-        if match:
-            # Remove optionally present quotes
-            self.album_tag = shlex.split(match.group(1))[0]
-
-    def _populate_artist_tag(self, line):
-        match = re.match('^PERFORMER (.*)$', line)
-        if match:
-            self.artist_tag = shlex.split(match.group(1))[0]
+        self._populate_header_tag(line)
 
-    def _populate_year_tag(self, line):
-        match = re.match('^REM DATE (.*)$', line)
+    def _populate_header_tag(self, line):
+        match = _HEADER_RE.match(line)
         if match:
-            self.year_tag = shlex.split(match.group(1))[0]
+            tag = _unquote_first(match.group(2))
+            setattr(self, CueAlbum.HEADER_TAGS[match.group(1)], tag)
 
     def get_disc(self, id):
         return self.cue_disks[id]
@@ -74,9 +98,9 @@ class CueDisc:
         self._populate_title_tag(line)
 
     def _populate_title_tag(self, line):
-        match = re.match('([ \t]+)?TITLE (.*)$', line)
+        match = _DISC_TITLE_RE.match(line)
         if match:
-            self.titles_tags.append(shlex.split(match.group(2))[0])
+            self.titles_tags.append(_unquote_first(match.group(1)))
 
 class Converter:
     def __init__(self):
@@ -94,27 +118,52 @@ class Converter:
     def convert(self):
         if not args.debug:
             FileUtils.clean_up_old_dirs(self.src_dir)
-        files_dict = FileUtils.scan_directory(self.src_dir, self.scan_recursively)
-        if FileUtils.hasExtension(files_dict, 'cue') and not args.ignore_cue_files:
+        # only cue sheets and convertible music files are ever used
+        allowed_exts = frozenset(SUPPORTED_SOURCE_FORMATS + ['cue'])
+        files_dict = FileUtils.scan_directory(self.src_dir, self.scan_recursively, allowed_exts)
+        if 'cue' in files_dict and not args.ignore_cue_files:
             for cue_file in files_dict['cue']:
                 src_dir = os.path.dirname(cue_file)
                 CueConverter(cue_file, src_dir, self.__get_dest_dir(src_dir)).convert()
         else:
+            # Parallel ffmpeg processes already occupy all cores,
+            # let each of them use a single thread to not oversubscribe CPU
+            threads = 1 if args.jobs > 1 else 0
+            tasks = []
+            dest_files = set()
             for ext in SUPPORTED_SOURCE_FORMATS:
                 if ext in files_dict:
                     for file in files_dict[ext]:
-                        self.__convert_single_file(file, self.__get_dest_dir(os.path.dirname(file)))
-
-    def __convert_single_file(self, src_file, dest_dir):
+                        task = self.__prepare_single_file(
+                            file, self.__get_dest_dir(os.path.dirname(file)), threads)
+                        # Same named files from different dirs or with different extensions
+                        # map to the same flac. Never let two ffmpeg write it at once.
+                        if task[1] in dest_files:
+                            logging.error('Skip %s: flac file %s is already written from another file', file, task[1])
+                            continue
+                        dest_files.add(task[1])
+                        tasks.append(task)
+            # Every file is converted by its own ffmpeg process, so they are independent
+            # and can be spread across all available cores. Threads are enough to drive them.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                list(executor.map(convert_single_file, tasks))
+
+    def __prepare_single_file(self, src_file, dest_dir, threads):
+        # Create dest dir upfront so parallel workers don't race on it
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
         filename = os.path.basename(os.path.splitext(src_file)[0])
         destFile = os.path.join(dest_dir, filename + '.flac')
-        logging.info('Writing flac file: %s', destFile)
-        call(["ffmpeg", "-i", src_file, destFile])
+        return src_file, destFile, threads
 
 class CueConverter():
     FIRST_TRACK_START_NUMBER = 1
+    # shnsplit flags which are the same for every disc
+    SHNSPLIT_CMD = (
+        'shnsplit',
+        '-t', '%n. %t',
+        '-o', 'flac',
+        '-O', 'always')
 
     def __init__(self, cue_file, src_dir, dest_dir):
         self.cue_file = cue_file
@@ -124,47 +173,61 @@ class CueConverter():
         self.cue_album = self.parse_cue_file()
 
     def convert(self):
-        first_track_num = CueConverter.FIRST_TRACK_START_NUMBER
-        for cue_disc_id, cue_disc in enumerate(self.cue_album.cue_disks):
-            # Each single physical cue file may have more than one discs inside it
-            # referenced as FILE "name (LP1).flac" WAVE
-            # shnsplit does not support multiple cue discs inside single cue..
-            #
-            # Create temp cue file for each disc.
-            #Besides that it also fixes problem with incorrect new line separators
-            # when file was generated on Windows.
-            temp_cue = self.create_temp_cue_file(self.cue_album.header + cue_disc.cue_context)
-            try:
-                music_file_path = join(self.src_dir, cue_disc.music_file_name)
-                # create temp dir to make sure it has only shnsplit generated files
-                # it's necessary for tagging since we don't have direct filename mapping
-                # between shnsplit output and cue file
-                temp_dir = tempfile.mkdtemp(dir=self.src_dir, prefix=TMP_DIR_PREFIX)
-                self.split_file_by_cue_sheet(temp_cue, music_file_path, temp_dir, first_track_num)
-                self.remove_pregap_files(temp_dir)
-                CueToFlacTagUtils.tag_files(temp_dir, self.cue_album, cue_disc_id)
-                first_track_num += len(cue_disc.titles_tags)
-                FileUtils.move_to_newdir(temp_dir, self.dest_dir)
-            finally:
-                os.remove(temp_cue)
-                if not args.debug:
-                  shutil.rmtree(temp_dir)
+        cue_disks = self.cue_album.cue_disks
+        # Track numbers continue across discs, so compute each disc start upfront
+        # to keep discs independent from each other.
+        first_track_nums = itertools.accumulate(
+            [CueConverter.FIRST_TRACK_START_NUMBER] + [len(cue_disc.titles_tags) for cue_disc in cue_disks[:-1]])
+        # shnsplit and metaflac are external processes, threads are enough to run them in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(self._process_disc, cue_disc_id, cue_disc, first_track_num)
+                for cue_disc_id, (cue_disc, first_track_num) in enumerate(zip(cue_disks, first_track_nums))]
+            for future in futures:
+                future.result()
+
+    def _process_disc(self, cue_disc_id, cue_disc, first_track_num):
+        # Each single physical cue file may have more than one discs inside it
+        # referenced as FILE "name (LP1).flac" WAVE
+        # shnsplit does not support multiple cue discs inside single cue..
+        #
+        # Create temp cue file for each disc.
+        #Besides that it also fixes problem with incorrect new line separators
+        # when file was generated on Windows.
+        temp_cue = self.create_temp_cue_file(self.cue_album.header + cue_disc.cue_context)
+        try:
+            music_file_path = join(self.src_dir, cue_disc.music_file_name)
+            # create temp dir to make sure it has only shnsplit generated files
+            # it's necessary for tagging since we don't have direct filename mapping
+            # between shnsplit output and cue file
+            temp_dir = tempfile.mkdtemp(dir=self.src_dir, prefix=TMP_DIR_PREFIX)
+            self.split_file_by_cue_sheet(temp_cue, music_file_path, temp_dir, first_track_num)
+            self.remove_pregap_files(temp_dir)
+            CueToFlacTagUtils.tag_files(temp_dir, self.cue_album, cue_disc_id)
+            FileUtils.move_to_newdir(temp_dir, self.dest_dir)
+        finally:
+            os.remove(temp_cue)
+            if not args.debug:
+              shutil.rmtree(temp_dir)
 
     def remove_pregap_files(self, temp_dir):
         """shnsplit sometimes generates pregap files  which creates
         inconsistency between track numbers in cue and actual files in the dir.
         it confuses tagging algorithm. Just remove it since it useless.
         """
-        for pregap_file in glob.glob(os.path.join(glob.escape(temp_dir), '*pregap.flac')):
-            os.remove(pregap_file)
+        with os.scandir(temp_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('pregap.flac'):
+                    os.remove(entry.path)
 
     def parse_cue_file(self):
         logging.info('Read cue file: %s' + self.cue_file)
         cue_album = CueAlbum()
         for line in FileUtils.readTextFile(self.cue_file):
-            if line.startswith("FILE "):
+            # cheap first char check rejects almost every line before startswith
+            if line[:1] == 'F' and line.startswith("FILE "):
                 cue_album.append_cue_disc(CueDisc())
-                cue_album.get_last_disc().music_file_name = shlex.split(line)[1]
+                cue_album.get_last_disc().music_file_name = _parse_file_name(line)
             if len(cue_album.cue_disks) > 0:
                 line = CueConverter.fix_time_format(line)
                 cue_album.get_last_disc().append_to_cue_context(line)
@@ -175,9 +238,9 @@ class CueConverter():
 
     def create_temp_cue_file(self, cue_content_array):
         temp_cue = tempfile.NamedTemporaryFile(suffix='.cue', delete=False)
-        for line in cue_content_array:
-            temp_cue.write(line.encode('utf-8'))
-            temp_cue.write(os.linesep.encode('utf-8'))
+        if cue_content_array:
+            # join everything upfront to write the whole cue at once
+            temp_cue.write((os.linesep.join(cue_content_array) + os.linesep).encode('utf-8'))
         temp_cue.close()
         if not os.path.getsize(temp_cue.name):
             raise IOError('Temp cue file {}  is emty'.format(temp_cue))
@@ -186,30 +249,30 @@ class CueConverter():
     def split_file_by_cue_sheet(self, cue_file_path, music_file_path, out_dir, first_track_num):
         logging.info('Split cue file for %s:' + music_file_path)
         cmd = [
-            'shnsplit', '-f', cue_file_path,
-            '-t', '%n. %t' ,
+            *CueConverter.SHNSPLIT_CMD,
+            '-f', cue_file_path,
             '-c',  str(first_track_num),
             '-d', out_dir,
-            '-o', 'flac',
-            '-O',  "always" ,
             music_file_path]
-        logging.info('Split cmd: %s',  ' '.join(cmd))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info('Split cmd: %s',  ' '.join(cmd))
         try:
-            out  = check_output(cmd,universal_newlines=True,stderr=subprocess.STDOUT)
-            logging.info(out)
+            out  = check_output(cmd,universal_newlines=True,stdin=subprocess.DEVNULL,stderr=subprocess.STDOUT)
+            # same as for ffmpeg and metaflac output matters only on failure
+            logging.debug(out)
         except subprocess.CalledProcessError as e:
             logging.error('Failed to split cue %s for %s : %s', cue_file_path, music_file_path, e.output)
 
     # workaround shnsplit: error: m:ss.ff format can only be used with CD-quality files
     @staticmethod
     def fix_time_format(line):
-        if line.strip().startswith('INDEX '):
-            # TODO replace with regex matcher based on groups
-            line_as_list = line.replace(os.linesep, '').split(':')
-            line_as_list[-1] = line_as_list[-1] + '0' + os.linesep
-            return ':'.join(line_as_list)
-        else:
+        # plain substring search is much cheaper than regex for most lines which are not INDEX
+        if 'INDEX' not in line:
             return line
+        match = _INDEX_FIX_RE.match(line)
+        if match:
+            return match.group(1) + '0' + match.group(2)
+        return line
 
 class FileUtils():
     @staticmethod
@@ -218,67 +281,85 @@ class FileUtils():
             raise AttributeError(
                 'Could not create destination directory {}.'
                 'There is file exists with similar name'.format(dest_dir))
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
+        # discs are moved concurrently into the same dest dir
+        os.makedirs(dest_dir, exist_ok=True)
         for file in listdir(src_dir):
-            shutil.move(os.path.join(src_dir, file), os.path.join(dest_dir, file))
+            src_file = os.path.join(src_dir, file)
+            dest_file = os.path.join(dest_dir, file)
+            try:
+                # plain rename is enough when dest is on the same filesystem
+                os.replace(src_file, dest_file)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # metadata copy is not needed, tags are inside the flac file
+                shutil.move(src_file, dest_file, copy_function=shutil.copyfile)
 
     @staticmethod
     def clean_up_old_dirs(src_dir):
-        old_dirs = glob.glob(os.path.join(glob.escape(src_dir), TMP_DIR_PREFIX+'*'))
+        with os.scandir(src_dir) as entries:
+            old_dirs = [entry.path for entry in entries
+                        if entry.name.startswith(TMP_DIR_PREFIX) and entry.is_dir()]
         for old_dir in old_dirs:
             shutil.rmtree(old_dir)
 
     @staticmethod
-    def hasExtension(files_dict, ext):
-        return ext in files_dict
-
-    @staticmethod
-    def readTextFile(text_file, encoding='utf-8'):
-        f = codecs.open(text_file, "r", encoding=encoding)
+    def readTextFile(text_file):
+        """File is read once and decoded in memory,
+        so falling back to another encoding does not read it again.
+        """
+        with open(text_file, 'rb') as f:
+            raw = f.read()
         try:
-            return f.read().splitlines()
+            # utf-8-sig also drops BOM often written by Windows editors
+            return raw.decode('utf-8-sig').splitlines()
         except UnicodeDecodeError:
-            if encoding != 'utf-8':
-                raise IOError(
-                    'Failed to read file {} with fallback encoding {}. \n'
-                    'This cue is unsupported or has wrong format'.format(text_file, encoding))
             if not args.fallback_cue_encoding:
                 raise IOError(
                     'Failed to read file {} as unicode. \n'
                     'Please specify fallback encoding using --fallback_cue_encoding'.format(text_file))
-            return FileUtils.readTextFile(text_file, args.fallback_cue_encoding)
-        finally:
-            f.close()
+        try:
+            return raw.decode(args.fallback_cue_encoding).splitlines()
+        except UnicodeDecodeError:
+            raise IOError(
+                'Failed to read file {} with fallback encoding {}. \n'
+                'This cue is unsupported or has wrong format'.format(text_file, args.fallback_cue_encoding))
 
     @staticmethod
-    def scan_directory(src_dir, recursive):
-        files_dict = {}
-        FileUtils.__scan_directory_rec(src_dir, files_dict, recursive)
+    def scan_directory(src_dir, recursive, allowed_exts):
+        files_dict = collections.defaultdict(list)
+        FileUtils.__scan_directory_rec(src_dir, files_dict, recursive, allowed_exts)
         return files_dict
 
     @staticmethod
-    def __scan_directory_rec(src_dir, files_dict, recursive):
-        for f in listdir(src_dir):
-            full_file_name = join(src_dir, f)
-            if isfile(full_file_name):
-                file_ext = os.path.splitext(full_file_name)[1].lower()[1:]
-                if file_ext in files_dict:
-                    files_dict[file_ext].append(full_file_name)
-                else:
-                    files_dict[file_ext] = [full_file_name]
-            else:
-                if recursive:
-                    FileUtils.__scan_directory_rec(full_file_name, files_dict, recursive)
+    def __scan_directory_rec(src_dir, files_dict, recursive, allowed_exts):
+        # scandir entries carry the file type from the directory read itself,
+        # so no extra stat per file is needed
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    # splitext treats leading dots as part of the name, so '.cue' has no extension
+                    file_ext = os.path.splitext(entry.name)[1][1:].lower()
+                    if file_ext in allowed_exts:
+                        files_dict[file_ext].append(entry.path)
+                elif recursive and entry.is_dir():
+                    FileUtils.__scan_directory_rec(entry.path, files_dict, recursive, allowed_exts)
 
 
 class CueToFlacTagUtils():
     @staticmethod
     def tag_files(files_dir, cue_album, current_disc_id):
-        files = glob.glob(os.path.join(glob.escape(files_dir), '*.*'))
-        files.sort(key=os.path.getmtime)
+        # shnsplit writes tracks in cue order, so modification time gives track order
+        with os.scandir(files_dir) as entries:
+            files = sorted((entry.stat().st_mtime, entry.path) for entry in entries if entry.is_file())
+        files = [path for _, path in files]
+        titles_tags = cue_album.get_disc(current_disc_id).titles_tags
+        # album wide tags are the same for every track, build them once per disc
+        album_cmd = CueToFlacTagUtils.album_tags_cmd(cue_album)
+        # Discs are already tagged in parallel, so tracks of one disc go one by one
+        # to keep --jobs as the limit of running processes.
         for track_id, file in enumerate(files):
-            CueToFlacTagUtils.tag_single_file(file, cue_album, current_disc_id, track_id)
+            CueToFlacTagUtils.tag_single_file(file, album_cmd, titles_tags[track_id])
 
     @staticmethod
     def __add_if_present(cmd, param, tag):
@@ -286,15 +367,47 @@ class CueToFlacTagUtils():
             cmd.append('='.join([param, tag]))
 
     @staticmethod
-    def tag_single_file(flac_file, cue_album, disc_id, track_id):
+    def album_tags_cmd(cue_album):
         cmd = ['metaflac', '--preserve-modtime']
         CueToFlacTagUtils.__add_if_present(cmd,  '--set-tag=ARTIST', cue_album.artist_tag)
         CueToFlacTagUtils.__add_if_present(cmd, '--set-tag=ALBUM', cue_album.album_tag)
-        CueToFlacTagUtils.__add_if_present(cmd, '--set-tag=TITLE', cue_album.get_disc(disc_id).titles_tags[track_id])
         CueToFlacTagUtils.__add_if_present(cmd, '--set-tag=DATE', cue_album.year_tag)
+        return cmd
+
+    @staticmethod
+    def tag_single_file(flac_file, album_cmd, title_tag):
+        cmd = list(album_cmd)
+        CueToFlacTagUtils.__add_if_present(cmd, '--set-tag=TITLE', title_tag)
         cmd.append(flac_file)
         logging.info('Tag flac file command: %s', ' '.join(cmd))
-        call(cmd)
+        result = subprocess.run(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode:
+            logging.error('Failed to tag %s : %s', flac_file, result.stderr)
+
+def convert_single_file(task):
+    """Converts (src_file, dest_file, threads) task with ffmpeg."""
+    src_file, destFile, threads = task
+    logging.info('Writing flac file: %s', destFile)
+    # Keep ffmpeg quiet and non interactive since many of them run at once.
+    # Its output is only interesting when conversion failed.
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+         "-i", src_file, "-threads", str(threads), destFile],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode:
+        logging.error('Failed to convert %s : %s', src_file, result.stderr)
+
+def positive_int(value):
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('must be a positive integer')
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer')
+    return jobs
 
 def parse_ags():
     parser = argparse.ArgumentParser(
@@ -312,7 +425,9 @@ def parse_ags():
             ' forces converter to read cue file using cp1251 encoding if it fails to read it as unicode.',
             '--src_dir=/music/cue --dest_dir=flac --only_top_dir',
             ' only the files in /music/cue will be scanned.'
-            ' all subdirs will be egnored'
+            ' all subdirs will be egnored',
+            '--src_dir=/music/cue --dest_dir=flac --jobs=1',
+            ' converts files one by one instead of in parallel.'
         ])
     )
     parser.add_argument("--src_dir",
@@ -366,6 +481,19 @@ def parse_ags():
                         ])
                         )
 
+    parser.add_argument("--jobs",
+                        type=positive_int,
+                        # cpu_count() may be unknown
+                        default=os.cpu_count() or 1,
+                        help=
+                        '\n'.join([
+                            'Number of files converted in parallel.',
+                            'Default value is the number of CPUs.',
+                            'Every file is converted independently by its own process,',
+                            '  so with more than one job each ffmpeg is limited to a single thread.',
+                        ])
+                        )
+
     return parser.parse_args()
 
 def get_logger_config(level):